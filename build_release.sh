@@ -10,6 +10,8 @@ pip install -r requirements.txt
 
 pip install pyinstaller
 
-pyinstaller --onefile --clean main.py
+# tiktoken discovers its encodings through the tiktoken_ext namespace package,
+# which pyinstaller can't see
+pyinstaller --onefile --clean --hidden-import tiktoken_ext.openai_public --hidden-import tiktoken_ext main.py
 
 echo "Binary file is at ./dist/main"
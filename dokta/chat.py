@@ -1,20 +1,31 @@
 import argparse
 import os
+import sys
 import json
+import functools
+from itertools import accumulate, takewhile
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
-import requests
 from .structs import State
 from .prompt import get_prompt, ANSWER
 from .config import get_model_config
 from .print_colors import print_yellow, print_red
-from .convo_db import setup_database_connection, add_entry, get_entries_past_week, DB_NAME, Db
+from .convo_db import setup_database_connection, add_entry, get_recent_entries, DB_NAME, Db
 from .constants import ROLE_USER, ROLE_ASSISTANT
+from .models import ConversationEntry
+from .exceptions import ApiRequestException
 
 
 
-# 'cl100k_base' is for gpt-4 and gpt-3.5-turbo
-# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-#ENCODER = tiktoken.get_encoding('cl100k_base')
 STATE = State(model='', max_tokens=0)
 ANTHROPIC_MODEL_MAP = {
     "opus": "claude-3-opus-20240229",
@@ -27,6 +38,23 @@ BACKEND_OLLAMA = "ollama"
 BACKEND_ANTHROPIC = "anthropic"
 BACKEND_GROQ = "groq"
 
+ANTHROPIC_URL = "https://api.anthropic.com/v1/messages"
+OLLAMA_URL = "http://localhost:11434/api/chat"
+
+
+# one pooled session for the lifetime of the process so that turns and
+# retries reuse the keep-alive (and TLS) connection to the provider.
+# requests is by far the slowest import of the CLI, so it is only imported
+# once the first message is sent.
+@functools.lru_cache(maxsize=1)
+def _http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+    return session
+
 
 def messages_to_prompt(messages): # -> str:
     prompt = ""
@@ -44,28 +72,51 @@ def estimate_token_count(messages,  # List[Dict[str, str]]
         count += count_tokens(message['content'])
     return count
 
-def load_conversation_history(db_session, state: State): # -> List[Dict[str, str]]:
+def _fit_newest(entries, max_tokens):
+    """Leading run of the newest-first `entries` that fits in `max_tokens`."""
+    # running totals of the token counts, consumed lazily so that counting
+    # stops at the first total over budget
+    totals = accumulate(count_tokens(f"{entry.role}: {entry.content}\n") for entry in entries)
+    return entries[:sum(1 for _ in takewhile(lambda total: total <= max_tokens, totals))]
+
+
+def load_conversation_history(db_session, state: State, pending=None): # -> List[Dict[str, str]]:
+    """`pending` is a not yet stored entry, sent as the newest message."""
     max_tokens = state.max_tokens
     session_id = state.session_id
-    entries = get_entries_past_week(db_session, session_id=session_id)
-
-    token_count = 0
-    conversation_text = []
-    for entry in reversed(entries):
-        entry_text = f"{entry.role}: {entry.content}\n"
-        entry_token_count = count_tokens(entry_text)
-        if token_count + entry_token_count <= max_tokens:
-            conversation_text.append({"role": entry.role, "content": entry.content})
-            token_count += entry_token_count
-        else:
-            break
-    return conversation_text[::-1]
+    # rows come back newest first; every entry costs at least 2 tokens
+    # ("user: x"), so this cap never drops anything that fits the budget
+    limit = max(16, max_tokens // 2)
+    entries = get_recent_entries(db_session, session_id, limit)
+    if pending is not None:
+        entries.insert(0, pending)
+
+    # Keep the history starting at the same entry as the previous turn for as
+    # long as it fits, so the prompt prefix is unchanged and the provider's
+    # prompt cache keeps hitting. Without an anchor (new process, switched
+    # session) send everything that fits. Only when the history overflows is the
+    # start moved forward to half the budget, so the following turns can again
+    # append without moving it.
+    kept = None
+    if state.history_anchor is not None and state.history_anchor[0] == session_id:
+        anchor_id = state.history_anchor[1]
+        window = list(takewhile(lambda entry: entry.id is None or entry.id >= anchor_id, entries))
+        kept = _fit_newest(window, max_tokens)
+        if len(kept) < len(window):
+            kept = None
+    if kept is None:
+        kept = _fit_newest(entries, max_tokens)
+        if len(kept) < len(entries):
+            kept = _fit_newest(entries, max_tokens // 2) or kept[:1]
+
+    if kept and kept[-1].id is not None:
+        state.history_anchor = (session_id, kept[-1].id)
+    return [{"role": entry.role, "content": entry.content} for entry in reversed(kept)]
 
 
 
 def chat(messages, state: State):
-    config = get_model_config(state.model)
-    backend = config.get("backend", BACKEND_OPENAI)
+    backend = state.config.get("backend", BACKEND_OPENAI)
     if backend == BACKEND_OLLAMA:
         return chat_with_ollama(messages, state)
     elif backend == BACKEND_ANTHROPIC:
@@ -79,13 +130,15 @@ def chat(messages, state: State):
 import time
 from functools import wraps
 
-def retry(max_attempts=3, delay_ms=1000):
+def retry(max_attempts=3, delay_ms=1000, max_delay_ms=4000, retry_if=None):
     """
     A decorator that retries a function up to `max_attempts` times if it raises an exception.
 
     Args:
         max_attempts (int): The maximum number of attempts to make.
-        delay_ms (int): The delay_ms in milliseconds between each attempt.
+        delay_ms (int): The delay_ms in milliseconds before the first retry, doubled after each attempt.
+        max_delay_ms (int): Upper bound in milliseconds for the delay between attempts.
+        retry_if (callable): Predicate on the raised exception. Exceptions it rejects are re-raised immediately.
 
     Returns:
         A decorator that retries the decorated function.
@@ -94,20 +147,61 @@ def retry(max_attempts=3, delay_ms=1000):
         @wraps(func)
         def wrapper(*args, **kwargs):
             attempts = 0
-            while attempts < max_attempts:
+            while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
-                    print(f"Function {func.__name__} raised an exception: {e}")
                     attempts += 1
-                    if attempts < max_attempts:
-                        print(f"Retrying function {func.__name__} ({attempts}/{max_attempts})")
-                        time.sleep(delay_ms / 1000)  # Convert delay_ms from milliseconds to seconds
-            raise Exception(f"Function {func.__name__} failed after {max_attempts} attempts.")
+                    if attempts >= max_attempts or (retry_if is not None and not retry_if(e)):
+                        raise
+                    print(f"Function {func.__name__} raised an exception: {e}")
+                    print(f"Retrying function {func.__name__} ({attempts}/{max_attempts})")
+                    delay = min(delay_ms * 2 ** (attempts - 1), max_delay_ms)
+                    time.sleep(delay / 1000)  # Convert delay from milliseconds to seconds
         return wrapper
     return decorator
 
-@retry(max_attempts=3, delay_ms=500)
+
+def _is_transient_error(error):
+    import requests
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+# the chat_with_* backends are generators, so retrying them would only retry
+# creating the generator; retry the request that opens the stream instead
+@retry(max_attempts=3, delay_ms=500, retry_if=_is_transient_error)
+def _post_stream(url, **kwargs):
+    response = _http_session().post(url, stream=True, **kwargs)
+    if response.status_code >= 500:
+        # read the (short) error body before closing: closing an unread
+        # streamed response drops the connection instead of pooling it
+        response.content
+        response.close()
+        response.raise_for_status()
+    return response
+
+
+def _raise_for_client_error(response, provider):
+    # 4xx (bad api key, unknown model, ...) won't succeed on a retry
+    if 400 <= response.status_code < 500:
+        raise ApiRequestException(f"Error receiving response from {provider} server: {response.text}")
+
+
+@functools.lru_cache(maxsize=1)
+def _anthropic_headers():
+    if "ANTHROPIC_API_KEY" not in os.environ:
+        print_red("Please set env var ANTHROPIC_API_KEY")
+        exit(1)
+    return {
+        "x-api-key": os.environ["ANTHROPIC_API_KEY"],
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json",
+        "connection": "keep-alive",
+    }
+
+
 def chat_with_anthropic(messages,  # List[Dict[str, str]]
                         state: State):
     conversation = [msg for msg in messages.copy() if msg['content'].strip() != '']
@@ -120,6 +214,18 @@ def chat_with_anthropic(messages,  # List[Dict[str, str]]
         else:
             i += 1
 
+    # mark the end of the prefix shared with the next turn as cacheable
+    if len(conversation) > 1:
+        last_stable = conversation[-2]
+        conversation[-2] = {
+            "role": last_stable['role'],
+            "content": [{
+                "type": "text",
+                "text": last_stable['content'],
+                "cache_control": {"type": "ephemeral"},
+            }],
+        }
+
     actual_model = ANTHROPIC_MODEL_MAP[state.model]
     if not actual_model:
         raise ValueError(f"Model {state.model} not found in ANTHROPIC_MODEL_MAP")
@@ -128,42 +234,45 @@ def chat_with_anthropic(messages,  # List[Dict[str, str]]
     # but output is capped at 4096 tokens
     max_tokens = 4096
 
-    if "ANTHROPIC_API_KEY" not in os.environ:
-        print_red("Please set env var ANTHROPIC_API_KEY")
-        exit(1)
-
-    response = requests.post(
-        "https://api.anthropic.com/v1/messages",
-        headers={
-            "x-api-key": os.environ["ANTHROPIC_API_KEY"],
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json",
-        },
+    response = _post_stream(
+        ANTHROPIC_URL,
+        headers=_anthropic_headers(),
         json={
             "model": actual_model,
             "max_tokens": max_tokens,
             "messages": conversation,
             "stream": True
-        }
+        },
     )
-    for line in response.iter_lines():
-        line = line.decode('utf-8')
-        # if line is a JSON with 'error', treat this as an error
-        try:
-            chunk = json.loads(line)
-            if 'error' in chunk:
-                raise Exception("Error receiving response from anthropic server: " + str(chunk['error']))
-        except json.decoder.JSONDecodeError:
-            pass
-        if line.startswith('data: '):
-            chunk = json.loads(line[6:].strip())
+    _raise_for_client_error(response, "anthropic")
+
+    # split the raw byte stream on SSE event boundaries ourselves; only the
+    # `data: ` payload of each event is ever decoded
+    buf = bytearray()
+    for data in response.iter_content(chunk_size=None):
+        buf += data
+        while (idx := buf.find(b"\n\n")) != -1:
+            event = bytes(buf[:idx])
+            del buf[:idx + 2]
+            start = event.find(b"data: ")
+            if start == -1:
+                continue
+            chunk = json_loads(event[start + 6:].split(b"\n", 1)[0])
             if chunk['type'] == 'content_block_delta':
                 yield chunk['delta']['text']
             elif chunk['type'] == 'error':
                 raise Exception("Error receiving response from anthropic server: " + str(chunk['error']))
 
+    # errors such as a bad api key come back as a plain JSON body, not as SSE
+    if buf.strip():
+        try:
+            chunk = json_loads(bytes(buf))
+        except json.decoder.JSONDecodeError:
+            return
+        if 'error' in chunk:
+            raise Exception("Error receiving response from anthropic server: " + str(chunk['error']))
+
 
-@retry(max_attempts=3, delay_ms=500)
 def chat_with_grog(messages, # List[Dict[str, str]]
                    state: State):
 
@@ -174,7 +283,7 @@ def chat_with_grog(messages, # List[Dict[str, str]]
         exit(1)
 
     url = "https://api.groq.com/openai/v1/chat/completions"
-    response = requests.post(
+    response = _post_stream(
         url,
         headers={
             "Authorization": f"Bearer {os.environ['GROQ_API_KEY']}",
@@ -185,12 +294,14 @@ def chat_with_grog(messages, # List[Dict[str, str]]
             "messages": messages,
             "max_tokens": max_tokens,
             "stream": True
-        })
+        },
+    )
+    _raise_for_client_error(response, "groq")
     for line in response.iter_lines():
         # payload we want look like this b'data: {"id":"chatcmpl-e38cab93-3a9d-971e-acec-700dacf6a4c8","object":"chat.completion.chunk","created":1711526569,"model":"mixtral-8x7b-32768","system_fingerprint":"fp_1cc6d039b0","choices":[{"index":0,"delta":{"content":" scope"},"logprobs":null,"finish_reason":null}]}'
         if line.startswith(b'data: '):
             try:
-                chunk = json.loads(line[6:].strip())
+                chunk = json_loads(line[6:])
                 if chunk['object'] == 'chat.completion.chunk':
                     yield chunk['choices'][0]['delta']['content']
                 elif chunk['object'] == 'error':
@@ -202,8 +313,8 @@ def chat_with_grog(messages, # List[Dict[str, str]]
 
 def chat_with_ollama(messages, # List[Dict[str, str]]
                      state: State):
-    response = requests.post(
-        'http://localhost:11434/api/chat',
+    response = _http_session().post(
+        OLLAMA_URL,
         json={
             "model": state.model,
             "messages": messages,
@@ -214,7 +325,7 @@ def chat_with_ollama(messages, # List[Dict[str, str]]
         if line:
             # line looks like this:
             # {'model': 'openhermes2.5-mistral:7b', 'created_at': '2024-04-18T15:11:00.372464Z', 'message': {'role': 'assistant', 'content': 'Hello'}, 'done': False}
-            chunk = json.loads(line.decode('utf-8'))
+            chunk = json_loads(line)
             if 'error' in chunk:
                 raise Exception("Error receiving response from ollama server: " + chunk['error'])
             yield chunk['message']['content']
@@ -223,13 +334,14 @@ def chat_with_ollama(messages, # List[Dict[str, str]]
 
 
 
-@retry(max_attempts=3, delay_ms=500)
 def chat_with_openai(messages, # List[Dict[str, str]]
                      state: State):
     if "OPENAI_API_KEY" not in os.environ:
         print_red("Please set env var OPENAI_API_KEY")
         exit(1)
 
+    from requests.exceptions import RequestException
+
     url = "https://api.openai.com/v1/chat/completions"
     headers = {
         "Content-Type": "application/json",
@@ -254,8 +366,8 @@ def chat_with_openai(messages, # List[Dict[str, str]]
 
         timeout = 40
         try:
-            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=timeout)
-        except requests.exceptions.RequestException as e:
+            response = _post_stream(url, headers=headers, data=json.dumps(data), timeout=timeout)
+        except RequestException as e:
             print(f"Error: {e}")
             return None
 
@@ -285,11 +397,10 @@ def chat_with_openai(messages, # List[Dict[str, str]]
     response.raise_for_status()
 
     for chunk in response.iter_lines():
-        line = chunk.decode('utf-8')
-        if line.startswith('data: '):
+        if chunk.startswith(b'data: '):
             try:
                 try:
-                    json_chunk = json.loads(line[6:].strip())
+                    json_chunk = json_loads(chunk[6:])
                 except json.JSONDecodeError:
                     # not a valid JSON, skip
                     continue
@@ -304,19 +415,78 @@ def chat_with_openai(messages, # List[Dict[str, str]]
     
 
 
+@functools.lru_cache(maxsize=1)
+def _encoder():
+    # 'cl100k_base' is for gpt-4 and gpt-3.5-turbo, and close enough for the other models
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except (ValueError, OSError) as e:
+        # OSError: the encoding file is downloaded on first use, which fails offline.
+        # ValueError: unknown encoding, e.g. a build without the tiktoken_ext plugin.
+        print_yellow(f"Could not load tiktoken encoding, token counts are estimated: {e}")
+        return None
+
+
+# entries never change once written, so history re-counted on every turn hits the cache
+@functools.lru_cache(maxsize=4096)
 def count_tokens(text):
-    return len(text) // 4
+    encoder = _encoder()
+    if encoder is None:
+        return len(text) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def run_turn(db_session, state: State, user_message, answer_newline=False):
+    """Stream the answer to the user message to stdout, then store both."""
+    # the user message is only written once the answer is complete, so no
+    # write transaction is held open while waiting on the network
+    pending = ConversationEntry(ROLE_USER, user_message, state.session_id)
+    conversation_history = load_conversation_history(db_session, state, pending=pending)
+    if not conversation_history:
+        raise ValueError("Conversation history is empty")
+
+    parts = []
+    print()
+    print_yellow(ANSWER, newline=answer_newline)
+    for chunk in chat(conversation_history, state):
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        parts.append(chunk)
+    ai_response = "".join(parts)
+
+    print('\a')
+
+    # remove the "assistant:" prefix for ollam
+    if ai_response.startswith("assistant:"):
+        ai_response = ai_response[10:].strip()
+
+    with db_session:
+        add_entry(db_session, ROLE_USER, user_message, state.session_id, commit=False)
+        add_entry(db_session,
+                  ROLE_ASSISTANT,
+                  ai_response,
+                  state.session_id,
+                  model=state.model,
+                  commit=False,
+                  )
 
 
 def main():
     model = os.environ.get("CHATGPT_CLI_MODEL", "gpt-3.5-turbo")
-    max_tokens = get_model_config(model)["max_tokens"]
+    config = get_model_config(model)
+    max_tokens = config["max_tokens"]
+
+    db_session = setup_database_connection(DB_NAME)
+    db = Db(db_session)
 
     first_use = False
-    if not Db().get_last_session():
+    if not db.get_last_session():
         first_use = True
 
-    STATE = State(model, max_tokens, session_id=Db().create_chat_session())
+    STATE = State(model, max_tokens, session_id=db.create_chat_session(), config=config)
 
     parser = argparse.ArgumentParser(description='Chat with GPT-3')
     parser.add_argument('--question', '-q', type=str, help='Question for the assistant')
@@ -333,27 +503,7 @@ def main():
             print("Your message is too long. Please try again.")
             return
 
-        db_session = setup_database_connection(DB_NAME)
-        add_entry(db_session, ROLE_USER, question.strip(), STATE.session_id)
-
-        conversation_history = load_conversation_history(db_session, STATE)
-        if not conversation_history:
-            raise ValueError("Conversation history is empty")
-
-        ai_response = ""
-        print()
-        print_yellow(ANSWER, newline=False)
-        for chunk in chat(conversation_history, STATE):
-            print(chunk, end="")
-            ai_response += chunk
-
-        add_entry(db_session,
-                  ROLE_ASSISTANT,
-                  ai_response,
-                  STATE.session_id,
-                  )
-
-        print('\a')
+        run_turn(db_session, STATE, question.strip())
         exit(0)
 
     # one-off mode
@@ -362,35 +512,13 @@ def main():
             print("Your message is too long. Please try again.")
             exit(1)
 
-        db_session = setup_database_connection(DB_NAME)
-        add_entry(db_session, ROLE_USER, args.question, STATE.session_id)
-
-        conversation_history = load_conversation_history(db_session, STATE)
-        if not conversation_history:
-            raise ValueError("Conversation history is empty")
-
-        ai_response = ""
-        print()
-        print_yellow(ANSWER, newline=False)
-        for chunk in chat(conversation_history, STATE):
-            print(chunk, end="")
-            ai_response += chunk
-
-        add_entry(db_session,
-                  ROLE_ASSISTANT,
-                  ai_response,
-                  STATE.session_id,
-                  )
-
-        print('\a')
+        run_turn(db_session, STATE, args.question)
         exit(0)
 
     print_yellow(f"Using model: {model}. Context length: {max_tokens}")
     if first_use:
         print_yellow(f"\\help for help. \\model to change model. \\session to go to a previous session. \\rename_session to rename this session. Ctrl + c quit.")
 
-    db_session = setup_database_connection(DB_NAME)
-
     while True:
         user_message = get_prompt(STATE).strip()
 
@@ -398,31 +526,7 @@ def main():
         #     print("Your message is too long. Please try again.")
         #     continue
 
-        add_entry(db_session, ROLE_USER, user_message, STATE.session_id)
-
-        conversation_history = load_conversation_history(db_session, STATE)
-        if not conversation_history:
-            raise ValueError("Conversation history is empty")
-
-        ai_response = ""
-        print()
-        print_yellow(ANSWER)
-        for chunk in chat(conversation_history, STATE):
-            print(chunk, end="")
-            ai_response += chunk
-
-        print('\a')
-
-        # remove the "assistant:" prefix for ollam
-        if ai_response.startswith("assistant:"):
-            ai_response = ai_response[10:].strip()
-
-        add_entry(db_session,
-                  ROLE_ASSISTANT,
-                  ai_response,
-                  STATE.session_id,
-                  model=STATE.model,
-                  )
+        run_turn(db_session, STATE, user_message, answer_newline=True)
         print()
 
 
@@ -1,4 +1,5 @@
 import json
+import functools
 
 CONFIG = {
   "models": [
@@ -74,6 +75,7 @@ CONFIG = {
 
 
 
+@functools.lru_cache(maxsize=8)
 def get_model_config(model: str):  # -> Dict[str, Any]:
     try:
         model_config = next(m for m in CONFIG["models"] if m['name'] == model)
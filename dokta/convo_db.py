@@ -1,6 +1,8 @@
 import sqlite3
 import random
 import string
+import functools
+import time
 from datetime import datetime, timedelta
 from .models import ConversationEntry, Session
 import os
@@ -11,9 +13,19 @@ def random_hash(length=8):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 # Functions to interact with the database
+@functools.lru_cache(maxsize=None)
 def setup_database_connection(db_name):
+    # cached per db file: the schema setup only runs once per process and
+    # every caller shares the same connection
     conn = sqlite3.connect(db_name)
     c = conn.cursor()
+    # WAL + synchronous=NORMAL: commits append to the WAL without an fsync
+    # per transaction, reads go through mmap
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA mmap_size=268435456")
+    c.execute("PRAGMA cache_size=-8000")
+    c.execute("PRAGMA temp_store=MEMORY")
     c.execute("""CREATE TABLE IF NOT EXISTS session (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT DEFAULT NULL,
@@ -25,35 +37,58 @@ def setup_database_connection(db_name):
         content TEXT,
         model TEXT DEFAULT NULL,
         created_at TEXT NOT NULL,
-        session_id INTEGER DEFAULT NULL
+        session_id INTEGER DEFAULT NULL,
+        created_at_epoch INTEGER DEFAULT NULL
     )""")
+    columns = [row[1] for row in c.execute("PRAGMA table_info(conversation_entries)")]
+    if "created_at_epoch" not in columns:
+        # databases from before the column existed: add it and backfill from created_at
+        c.execute("ALTER TABLE conversation_entries ADD COLUMN created_at_epoch INTEGER DEFAULT NULL")
+        c.execute("UPDATE conversation_entries SET created_at_epoch = CAST(strftime('%s', created_at) AS INTEGER)")
     conn.commit()
+    ensure_indexes(conn)
     return conn
 
-def add_entry(conn, role, content, session_id=None, model=None):
+def ensure_indexes(conn):
+    # history is always read per session and by recency, so this lets sqlite
+    # range-scan one session's recent rows instead of scanning the table.
+    # Recency is compared on the integer epoch column rather than the ISO text.
     c = conn.cursor()
-    entry = ConversationEntry(role, content, session_id, model)
-    c.execute("INSERT INTO conversation_entries (role, content, model, created_at, session_id) VALUES (?, ?, ?, ?, ?)",
-              (entry.role, entry.content, entry.model, entry.created_at.isoformat(), entry.session_id))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_conversation_entries_session_created_at_epoch ON conversation_entries (session_id, created_at_epoch)")
     conn.commit()
+
+def add_entry(conn, role, content, session_id=None, model=None, commit=True):
+    c = conn.cursor()
+    entry = ConversationEntry(role, content, session_id, model)
+    c.execute("INSERT INTO conversation_entries (role, content, model, created_at, session_id, created_at_epoch) VALUES (?, ?, ?, ?, ?, ?)",
+              (entry.role, entry.content, entry.model, entry.created_at.isoformat(), entry.session_id, entry.created_at_epoch))
+    if commit:
+        conn.commit()
     entry.id = c.lastrowid
     return entry
 
 def get_entries_past_week(conn, session_id=None):
     c = conn.cursor()
-    one_week_ago = datetime.utcnow() - timedelta(weeks=1)
+    one_week_ago = int(time.time() - timedelta(weeks=1).total_seconds())
     if session_id is not None:
-        c.execute("SELECT id, role, content, model, created_at, session_id FROM conversation_entries WHERE created_at >= ? AND session_id = ?", (one_week_ago.isoformat(), session_id))
+        c.execute("SELECT id, role, content, model, created_at, session_id, created_at_epoch FROM conversation_entries WHERE session_id = ? AND created_at_epoch >= ?", (session_id, one_week_ago))
     else:
-        c.execute("SELECT id, role, content, model, created_at, session_id FROM conversation_entries WHERE created_at >= ?", (one_week_ago.isoformat(),))
-    rows = c.fetchall()
-    entries = []
-    for row in rows:
-        entry = ConversationEntry(row[1], row[2], row[5], row[3])
-        entry.id = row[0]
-        entry.created_at = datetime.fromisoformat(row[4])
-        entries.append(entry)
-    return entries
+        c.execute("SELECT id, role, content, model, created_at, session_id, created_at_epoch FROM conversation_entries WHERE created_at_epoch >= ?", (one_week_ago,))
+    return [_entry_from_row(row) for row in c.fetchall()]
+
+def get_recent_entries(conn, session_id, limit):
+    """Newest-first entries of the past week for a session, at most `limit` rows."""
+    c = conn.cursor()
+    one_week_ago = int(time.time() - timedelta(weeks=1).total_seconds())
+    c.execute("SELECT id, role, content, model, created_at, session_id, created_at_epoch FROM conversation_entries WHERE session_id = ? AND created_at_epoch >= ? ORDER BY created_at_epoch DESC, id DESC LIMIT ?", (session_id, one_week_ago, limit))
+    return [_entry_from_row(row) for row in c.fetchall()]
+
+def _entry_from_row(row):
+    entry = ConversationEntry(row[1], row[2], row[5], row[3])
+    entry.id = row[0]
+    entry.created_at = datetime.fromisoformat(row[4])
+    entry.created_at_epoch = row[6]
+    return entry
 
 def delete_entry(conn, entry_id):
     c = conn.cursor()
@@ -61,8 +96,10 @@ def delete_entry(conn, entry_id):
     conn.commit()
 
 class Db:
-    def __init__(self):
-        self.conn = setup_database_connection(DB_NAME)
+    def __init__(self, conn=None):
+        self.conn = conn if conn is not None else setup_database_connection(DB_NAME)
+        # session name -> Session, for repeated lookups from the prompt commands
+        self._name_cache = {}
 
     def create_chat_session(self, name=None):
         if name is None:
@@ -72,9 +109,12 @@ class Db:
         c.execute("INSERT INTO session (name, created_at) VALUES (?, ?)", (session.name, session.created_at.isoformat()))
         self.conn.commit()
         session.id = c.lastrowid
+        self._name_cache[session.name] = session
         return session.id
 
     def find_session(self, name):
+        if name in self._name_cache:
+            return self._name_cache[name]
         c = self.conn.cursor()
         c.execute("SELECT * FROM session WHERE name = ?", (name,))
         row = c.fetchone()
@@ -82,6 +122,7 @@ class Db:
             session = Session(row[1])
             session.id = row[0]
             session.created_at = datetime.fromisoformat(row[2])
+            self._name_cache[name] = session
             return session
         return None
 
@@ -101,6 +142,9 @@ class Db:
         c = self.conn.cursor()
         c.execute("UPDATE session SET name = ? WHERE id = ?", (new_name, session_id))
         self.conn.commit()
+        for name in [name for name, session in self._name_cache.items() if session.id == session_id]:
+            del self._name_cache[name]
+        self._name_cache.pop(new_name, None)
 
     def get_entries_past_week(self, session_id):
         return get_entries_past_week(self.conn, session_id)
@@ -1,3 +1,7 @@
 
 class InputResetException(Exception):
     pass
+
+
+class ApiRequestException(Exception):
+    pass
@@ -1,3 +1,4 @@
+import calendar
 from datetime import datetime
 
 # Define the ConversationEntry class
@@ -8,6 +9,7 @@ class ConversationEntry:
         self.content = content
         self.model = model
         self.created_at = datetime.utcnow()
+        self.created_at_epoch = calendar.timegm(self.created_at.utctimetuple())
         self.session_id = session_id
 
 class Session:
@@ -1,6 +1,7 @@
 import sys
 import os
 import re
+import functools
 import readline
 import subprocess
 import tempfile
@@ -44,6 +45,12 @@ FILE_REGEX = re.compile(r"\\file")
 HELP_REGEX = re.compile(r"\\help")
 
 
+@functools.lru_cache(maxsize=1)
+def get_db():
+    # one Db for all prompt commands so its session name cache is reused
+    return Db()
+
+
 def print_help():
     print()
     print_yellow("Type your message, then 'Enter' to send.")
@@ -127,12 +134,14 @@ def get_prompt(state, # : State
                     model = model_match.group(1).strip()
 
                     try:
-                        state.max_tokens = get_model_config(model)["max_tokens"]
+                        config = get_model_config(model)
                     except LookupError:
                         print_yellow("Please enter a valid model.")
                     else:
                         state.model = model
-                        backend = get_model_config(model).get("backend", "openai")
+                        state.config = config
+                        state.max_tokens = config["max_tokens"]
+                        backend = config.get("backend", "openai")
                         print_yellow(f"Using model: {state.model}. Max context: {state.max_tokens}. Provider: {backend}")
                 else:
                     print_yellow("Please enter a model. Like \\model gpt-4")
@@ -162,7 +171,7 @@ def get_prompt(state, # : State
                     session_name = re.match(r"\\session (.*)", line).group(1).strip()
                 except AttributeError:
                     session_name = random_hash()
-                db = Db()
+                db = get_db()
                 session = db.find_session(session_name)
                 if not session:
                     print_green(f"New session: {session_name}")
@@ -189,7 +198,7 @@ def get_prompt(state, # : State
                     user_message = ""
                     raise InputResetException()
 
-                db = Db()
+                db = get_db()
                 sesh = db.find_session(session_name)
                 if sesh:
                     id_ = random_hash()
@@ -204,7 +213,7 @@ def get_prompt(state, # : State
 
 
             if re.match(MESSAGES_REGEX, line):
-                db = Db()
+                db = get_db()
                 messages = db.get_entries_past_week(state.session_id)
                 sorted(messages,
                        key=lambda x: x.created_at,
@@ -226,7 +235,7 @@ def get_prompt(state, # : State
                 raise EOFError()
 
             if re.match(LIST_SESSION_REGEX, line):
-                db = Db()
+                db = get_db()
                 sessions = db.get_all_chat_sessions()
                 print()
                 print_yellow("Sessions:")
@@ -237,7 +246,7 @@ def get_prompt(state, # : State
 
 
             if re.match(LAST_SESSION_REGEX, line):
-                db = Db()
+                db = get_db()
                 try:
                     offset = re.match(r"\\last_session (\d+)", line).group(1)
                 except AttributeError:
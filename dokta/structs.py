@@ -7,3 +7,7 @@ class State:
     model: str
     max_tokens: int
     session_id: int = None
+    config: dict = None
+    # (session_id, entry_id) of the oldest entry sent as history, kept
+    # between turns so the prompt prefix stays the same
+    history_anchor: tuple = None
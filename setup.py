@@ -3,11 +3,11 @@ setup(
     name="dokta",
     version="0.1.0",
     packages=find_packages(),
+    python_requires=">=3.8",
     install_requires=[
-        "openai",
+        "requests>=2.28",
         "tiktoken",
-        "sqlalchemy",
-        "retrying",
+        "orjson",
     ],
     entry_points={
         "console_scripts": [